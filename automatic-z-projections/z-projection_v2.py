@@ -12,22 +12,179 @@ Created: Fri Jul 14 17:58:10 2023
 Updated: [Current Date]
 """
 
+import os
+import re
 import numpy as np
-from tifffile import imsave, imread
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from tifffile import imsave, TiffFile, TiffPageSeries
 import pandas as pd
 import time
 import warnings
-from typing import Tuple, List, Dict, Optional
+from typing import Tuple, List, Dict, Iterator, Optional
 from pathlib import Path
 
+try:
+    from numba import njit, prange, set_num_threads
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # Fall back to the NumPy implementation when Numba is not installed
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+    prange = range
+
 # Suppress warnings
 warnings.filterwarnings("ignore", message="In a future version")
 
+# Record layout of the per-timepoint processing report
+REPORT_DTYPE = np.dtype([
+    ('Timepoint', 'i4'),
+    ('Numb projected z', 'i4'),
+    ('Type of proj', 'U8'),
+    ('Start z', 'i4'),
+    ('Stop z', 'i4'),
+])
+
+# Target size in bytes of one (Z, band, X) tile in blocked projections (typical L2 size)
+PROJECTION_TILE_BYTES = 1 << 20
+
+
+def limit_numba_threads(n_threads: int) -> None:
+    """
+    Limit the threads used by the parallel kernels in the current process.
+    
+    Used as the worker initializer of the process pool, so that workers
+    together use about one thread per CPU instead of each starting one per CPU.
+    
+    Args:
+        n_threads: Number of Numba threads for this process
+    """
+    if NUMBA_AVAILABLE:
+        set_num_threads(n_threads)
+
+
+@njit(cache=True, parallel=True)
+def max_project(stack, out):
+    """
+    Maximum projection of a Z-stack, parallel over rows.
+    
+    The running maximum is kept in a row-local buffer, so the innermost loop
+    runs along contiguous X without touching `out` and LLVM can vectorize it.
+    
+    Args:
+        stack: 3D array (Z, Y, X)
+        out: 2D array (Y, X) to write the projection into
+    """
+    total_z, size_y, size_x = stack.shape
+    for y in prange(size_y):
+        buf = stack[0, y].copy()
+        for z in range(1, total_z):
+            for x in range(size_x):
+                buf[x] = max(buf[x], stack[z, y, x])
+        for x in range(size_x):
+            out[y, x] = buf[x]
+
+
+@njit(cache=True, parallel=True)
+def mean_project(stack, out):
+    """
+    Mean projection of a Z-stack with a uint32 accumulator, parallel over rows.
+    
+    Args:
+        stack: 3D array (Z, Y, X)
+        out: 2D array (Y, X) to write the projection into
+    """
+    total_z, size_y, size_x = stack.shape
+    for y in prange(size_y):
+        acc = np.zeros(size_x, dtype=np.uint32)
+        for z in range(total_z):
+            for x in range(size_x):
+                acc[x] += stack[z, y, x]
+        for x in range(size_x):
+            out[y, x] = acc[x] // total_z
+
+
+@njit(cache=True, parallel=True)
+def focus_and_project(img_tp, z_range, is_max, out):
+    """
+    Find the best focused Z-slice and project around it in a fused kernel.
+    
+    For every Z-slice, each row's mean and sum of squared deviations are
+    computed in parallel over Y (two reads per row, kept in (Y, Z) float64
+    arrays) and merged with Chan's update into numerically stable slice
+    variances. The selected slices are then projected straight into `out`.
+    
+    Args:
+        img_tp: 3D array (Z, Y, X)
+        z_range: Number of Z-slices above/below center for projection
+        is_max: True for a maximum projection, False for a mean projection
+        out: 2D array (Y, X) to write the projection into
+        
+    Returns:
+        Tuple of (best focused slice index, start index, stop index, projection)
+    """
+    total_z, size_y, size_x = img_tp.shape
+    
+    # Row-wise mean and sum of squared deviations for every Z-slice
+    row_mean = np.empty((size_y, total_z))
+    row_m2 = np.empty((size_y, total_z))
+    for y in prange(size_y):
+        for z in range(total_z):
+            acc = 0.0
+            for x in range(size_x):
+                acc += img_tp[z, y, x]
+            mean = acc / size_x
+            m2 = 0.0
+            for x in range(size_x):
+                d = img_tp[z, y, x] - mean
+                m2 += d * d
+            row_mean[y, z] = mean
+            row_m2[y, z] = m2
+    
+    # Merge rows into per-slice variances and keep the highest one
+    best_z = 0
+    best_m2 = -1.0
+    for z in range(total_z):
+        mean = row_mean[0, z]
+        m2 = row_m2[0, z]
+        for y in range(1, size_y):
+            n_a = y * size_x
+            delta = row_mean[y, z] - mean
+            mean += delta * size_x / (n_a + size_x)
+            m2 += row_m2[y, z] + delta * delta * n_a * size_x / (n_a + size_x)
+        if m2 > best_m2:
+            best_m2 = m2
+            best_z = z
+    
+    # Same edge-case handling as ImageProjector.calculate_projection_range
+    n_slices = 2 * z_range + 1
+    start = best_z - z_range
+    stop = best_z + z_range + 1
+    if start < 0:
+        start = 0
+        stop = min(n_slices, total_z)
+    elif stop > total_z:
+        start = max(0, total_z - n_slices)
+        stop = total_z
+    
+    # Project the selected slices straight into the output image
+    if is_max:
+        max_project(img_tp[start:stop], out)
+    else:
+        mean_project(img_tp[start:stop], out)
+    
+    return best_z, start, stop, out
+
+
 class ImageProjector:
     """Class to handle image projection operations for microscopy data."""
     
     def __init__(self, folder: str, channels: List[str], projection_type: str = 'max', 
-                 z_range: int = 1, output_dir: Optional[str] = None):
+                 z_range: int = 1, output_dir: Optional[str] = None,
+                 max_workers: Optional[int] = None):
         """
         Initialize the ImageProjector.
         
@@ -37,34 +194,51 @@ class ImageProjector:
             projection_type: Type of projection ('max' or 'mean')
             z_range: Number of Z-slices above/below center for projection
             output_dir: Output directory (defaults to 'projection' in input folder)
+            max_workers: Number of files processed in parallel (defaults to CPU count)
         """
         self.folder = Path(folder)
         self.channels = channels
+        # Single pattern matching any of the channel names
+        self._channel_re = re.compile('|'.join(re.escape(c) for c in channels)) if channels else None
         self.projection_type = projection_type
         self.z_range = z_range
         self.output_dir = Path(output_dir) if output_dir else self.folder / 'projection'
+        self.max_workers = max_workers or os.cpu_count()
         self.report_data = {}
         self.processed_count = 0
         
+        # Background writer, only used when files are processed in this process
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._write_futs: List[Tuple[str, Path, Future]] = []
+        # Stems of files whose background write failed, left out of the report
+        self._failed_writes = set()
+        
         # Create output directory
         self.output_dir.mkdir(exist_ok=True)
         
-    def get_focused_z_slice(self, image: np.ndarray) -> Tuple[np.ndarray, int]:
+    def get_focused_z_slice(self, image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
         """
-        Determine the most focused Z-slice by calculating standard deviation.
-        Higher standard deviation indicates better focus.
+        Determine the most focused Z-slice of every timepoint by comparing
+        pixel variance. Higher variance (standard deviation) indicates better focus.
+        
+        Only the ranking of slices matters, so the square root and the division
+        by the pixel count are dropped and the sums are kept in integer dtypes.
         
         Args:
-            image: 3D array (Z, Y, X)
+            image: 4D array (T, Z, Y, X)
             
         Returns:
-            Tuple of (standard deviations, index of best focused slice)
+            Tuple of (variance proxies (T, Z), best focused slice per timepoint (T,))
         """
-        # Calculate standard deviation for each Z-slice
-        std_devs = image.std(axis=(1, 2))
-        # Find the Z-slice with maximum standard deviation (best focus)
-        best_z = std_devs.argmax()
-        return std_devs, best_z
+        n_pixels = image.shape[2] * image.shape[3]
+        # Sum and sum of squares for each Z-slice (uint16 squared fits in uint64)
+        s1 = image.sum(axis=(2, 3), dtype=np.uint64)
+        s2 = np.einsum('tzyx,tzyx->tz', image, image, dtype=np.uint64)
+        # N^2 * variance; combined in float64 as the products overflow uint64
+        proxies = s2.astype(np.float64) * n_pixels - s1.astype(np.float64) ** 2
+        # Find the Z-slice with maximum variance (best focus)
+        best_zs = proxies.argmax(axis=1)
+        return proxies, best_zs
     
     def calculate_projection_range(self, best_z: int, total_z: int) -> Tuple[int, int, int]:
         """
@@ -92,106 +266,288 @@ class ImageProjector:
                 
         return start, stop, n_slices
     
-    def perform_projection(self, image_stack: np.ndarray) -> np.ndarray:
+    def perform_projection(self, image_stack: np.ndarray,
+                           out: Optional[np.ndarray] = None) -> np.ndarray:
         """
         Perform projection on a Z-stack.
         
+        Uses the compiled kernels when Numba is available. Otherwise the stack
+        is reduced in bands of rows so that each band is read from cache rather
+        than main memory while walking along Z.
+        
         Args:
             image_stack: 3D array (Z, Y, X)
+            out: Optional 2D array (Y, X) to write the projection into
             
         Returns:
             2D projected image
         """
         if self.projection_type == 'mean':
-            return np.mean(image_stack, axis=0, dtype=np.uint16)
+            dtype = np.uint16
         elif self.projection_type == 'max':
-            return np.max(image_stack, axis=0)
+            dtype = image_stack.dtype
         else:
             raise ValueError(f"Unsupported projection type: {self.projection_type}")
+        
+        if out is None:
+            out = np.empty(image_stack.shape[1:], dtype=dtype)
+        
+        if NUMBA_AVAILABLE:
+            if self.projection_type == 'mean':
+                mean_project(image_stack, out)
+            else:
+                max_project(image_stack, out)
+            return out
+        
+        # Band height so that a tile fits the cache budget (at least one row)
+        total_z, _, size_x = image_stack.shape
+        block_rows = max(1, PROJECTION_TILE_BYTES // (total_z * size_x * image_stack.itemsize))
+        
+        for y0 in range(0, image_stack.shape[1], block_rows):
+            band = slice(y0, y0 + block_rows)
+            if self.projection_type == 'mean':
+                # Accumulate in uint32 so sums of uint16 slices cannot wrap around
+                acc = np.add.reduce(image_stack[:, band], axis=0, dtype=np.uint32)
+                np.floor_divide(acc, image_stack.shape[0], out=out[band], casting='unsafe')
+            else:
+                np.max(image_stack[:, band], axis=0, out=out[band])
+        return out
     
-    def process_tiff_file(self, file_path: Path) -> None:
-        """Process a single TIFF file."""
-        try:
-            # Read the TIFF image
-            img = imread(str(file_path))
-            shape = img.shape
-            
-            # Check if image has enough dimensions (should be 4D: T, Z, Y, X)
-            if len(shape) <= 3:
-                print(f"Skipping {file_path.name}: insufficient dimensions")
-                return
-                
-            self.processed_count += 1
-            print(f"Processing TIFF: {file_path.name}")
+    @staticmethod
+    def open_series(series: TiffPageSeries) -> Optional[np.ndarray]:
+        """
+        Get a 4D TIFF series as a whole array when that needs no page-wise decoding.
+        
+        Uncompressed, contiguous data is memory-mapped, so timepoints are
+        read-only views backed by the OS page cache (in the file's byte order;
+        the ImageJ default is big-endian). Series that are not stored as one
+        page per 2D plane are read whole.
+        
+        Args:
+            series: TIFF page series with shape (T, Z, Y, X)
             
-            # Initialize output array for projected timepoints
-            output_shape = (1, shape[2], shape[3])
-            img_proj_tp = np.empty(output_shape, dtype=np.uint16)
+        Returns:
+            4D array (T, Z, Y, X), or None if the series should be streamed page-wise
+        """
+        total_t, total_z = series.shape[:2]
+        if series.dataoffset is not None:
+            # Same mapping as tifffile.memmap, on the file the series belongs to
+            tif = series.parent
+            try:
+                return np.memmap(tif.filehandle.path, dtype=tif.byteorder + series.dtype.char,
+                                 mode='r', offset=series.dataoffset, shape=series.shape)
+            except (ValueError, OSError):
+                pass
+        if len(series.pages) != total_t * total_z:
+            return series.asarray()
+        return None
+    
+    @staticmethod
+    def iter_timepoints(series: TiffPageSeries, img: Optional[np.ndarray]) -> Iterator[np.ndarray]:
+        """
+        Read a 4D TIFF series one timepoint at a time.
+        
+        Timepoints of an array from open_series are yielded as views, converted
+        one at a time if not in native byte order. Otherwise only the pages of
+        the current Z-stack are decoded, so memory use is bounded by a single
+        timepoint.
+        
+        Args:
+            series: TIFF page series with shape (T, Z, Y, X)
+            img: Whole series from open_series, or None to decode page-wise
             
-            # Lists to store processing information for report
-            timepoints, n_proj_z, proj_types, start_z, stop_z = [], [], [], [], []
+        Yields:
+            3D array (Z, Y, X) in native byte order for each timepoint
+        """
+        total_t, total_z, size_y, size_x = series.shape
+        if img is not None:
+            native = img.dtype.newbyteorder('=')
+            for t in range(total_t):
+                yield img[t] if img.dtype.isnative else img[t].astype(native)
+            return
+        for t in range(total_t):
+            stack = series.asarray(key=slice(t * total_z, (t + 1) * total_z))
+            yield stack.reshape(total_z, size_y, size_x)
+    
+    def process_tiff_file(self, file_path: Path) -> Optional[Tuple[str, np.ndarray]]:
+        """
+        Process a single TIFF file.
+        
+        Returns the report instead of storing it, so it can run in a worker
+        process. When a background writer is active (single-process runs), the
+        pending write is queued on the projector.
+        
+        Args:
+            file_path: Path to the TIFF file
             
-            # Process each timepoint
-            for t in range(shape[0]):
-                # Extract single timepoint
-                img_tp = img.take(t, axis=0)
-                timepoints.append(t + 1)
-                proj_types.append(self.projection_type)
+        Returns:
+            Tuple of (file stem, report records as REPORT_DTYPE array), or None if
+            the file was skipped
+        """
+        try:
+            # Open the TIFF lazily; timepoints are mapped or decoded one at a time
+            with TiffFile(str(file_path)) as tif:
+                series = tif.series[0]
+                shape = series.shape
                 
-                # Find best focused Z-slice
-                _, best_z = self.get_focused_z_slice(img_tp)
+                # Check if image has the right dimensions (should be 4D: T, Z, Y, X)
+                if len(shape) != 4:
+                    print(f"Skipping {file_path.name}: expected 4D (T, Z, Y, X), got {len(shape)}D")
+                    return None
+                    
+                print(f"Processing TIFF: {file_path.name}")
                 
-                # Calculate which Z-slices to include in projection
-                start, stop, n_slices = self.calculate_projection_range(best_z, shape[1])
-                n_proj_z.append(n_slices)
+                # Preallocate output array for projected timepoints
+                output_shape = (shape[0], shape[2], shape[3])
+                img_proj_tp = np.empty(output_shape, dtype=np.uint16)
                 
-                # Extract the Z-stack for projection
-                indices = range(start, stop)
-                start_z.append(indices[0] + 1)  # +1 for Fiji compatibility
-                stop_z.append(indices[-1] + 1)
+                if self.projection_type not in ('max', 'mean'):
+                    raise ValueError(f"Unsupported projection type: {self.projection_type}")
+                is_max = self.projection_type == 'max'
                 
-                img_z_stack = img_tp.take(indices, axis=0)
-                img_proj = self.perform_projection(img_z_stack)
+                # The range covers the whole stack regardless of focus, so skip focus detection
+                full_stack = 2 * self.z_range + 1 >= shape[1]
                 
-                # Add time dimension and concatenate with previous results
-                img_proj = np.expand_dims(img_proj, axis=0)
-                img_proj_tp = np.concatenate((img_proj_tp, img_proj), dtype=np.uint16)
-            
-            # Remove the initial empty array
-            img_proj_tp = img_proj_tp[1:]
+                # Whole series when mapped or read at once, None when streamed page-wise
+                img = self.open_series(series)
+                
+                best_zs = None
+                if img is not None and not full_stack and not NUMBA_AVAILABLE:
+                    # Find best focused Z-slice of every timepoint at once
+                    _, best_zs = self.get_focused_z_slice(img)
+                
+                # Processing information for report, one record per timepoint
+                report = np.empty(shape[0], dtype=REPORT_DTYPE)
+                n_slices = 2 * self.z_range + 1
+                
+                # Process each timepoint
+                for t, img_tp in enumerate(self.iter_timepoints(series, img)):
+                    if full_stack:
+                        start, stop = 0, shape[1]
+                        self.perform_projection(img_tp, out=img_proj_tp[t])
+                    elif NUMBA_AVAILABLE:
+                        # Fused focus detection and projection into the output slot
+                        _, start, stop, _ = focus_and_project(img_tp, self.z_range, is_max,
+                                                              img_proj_tp[t])
+                    else:
+                        if best_zs is not None:
+                            best_z = best_zs[t]
+                        else:
+                            # Find best focused Z-slice of this streamed timepoint
+                            _, tp_best_zs = self.get_focused_z_slice(img_tp[np.newaxis])
+                            best_z = tp_best_zs[0]
+                        
+                        # Calculate which Z-slices to include in projection
+                        start, stop, _ = self.calculate_projection_range(best_z, shape[1])
+                        
+                        # Extract the Z-stack for projection (a view, no copy)
+                        img_z_stack = img_tp[start:stop]
+                        
+                        # Project directly into the preallocated timepoint slot
+                        self.perform_projection(img_z_stack, out=img_proj_tp[t])
+                    
+                    # +1 on start for Fiji compatibility
+                    report[t] = (t + 1, n_slices, self.projection_type, start + 1, stop)
             
             # Save the projected image
             output_name = f"{file_path.stem}_{self.projection_type}proj.tif"
             output_path = self.output_dir / output_name
-            imsave(str(output_path), img_proj_tp)
+            self.save_projection(file_path.stem, output_path, img_proj_tp)
             
-            # Store processing information for report
-            self.report_data[file_path.stem] = {
-                'Timepoint': timepoints,
-                'Numb projected z': n_proj_z,
-                'Type of proj': proj_types,
-                'Start z': start_z,
-                'Stop z': stop_z
-            }
+            # Return processing information for report
+            return file_path.stem, report
             
         except Exception as e:
             print(f"Error processing {file_path.name}: {e}")
+            return None
+    
+    def save_projection(self, stem: str, output_path: Path, image: np.ndarray) -> None:
+        """
+        Save a projected image, in the background if a writer is active.
+        
+        At most two writes are kept pending so finished projections do not
+        pile up in memory when the disk is slower than the computation.
+        
+        Args:
+            stem: Stem of the input file, used to track failed writes
+            output_path: Path of the output TIFF file
+            image: Projected image (T, Y, X)
+        """
+        if self._writer is None:
+            imsave(str(output_path), image)
+            return
+        
+        while len(self._write_futs) >= 2:
+            self.wait_for_write(*self._write_futs.pop(0))
+        self._write_futs.append((stem, output_path, self._writer.submit(imsave, str(output_path), image)))
+    
+    def wait_for_write(self, stem: str, output_path: Path, future: Future) -> None:
+        """Wait for a background write to finish and record any failure."""
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error saving {output_path.name}: {e}")
+            self._failed_writes.add(stem)
     
     def save_report(self) -> None:
-        """Save processing report to Excel file."""
+        """Save processing report of all images to a single-sheet Excel file."""
         if not self.report_data:
             print("No data to report")
             return
             
         report_path = self.output_dir / 'projection_report.xlsx'
         
-        with pd.ExcelWriter(report_path) as writer:
-            for image_name, report_data in self.report_data.items():
-                df = pd.DataFrame(report_data)
-                df.to_excel(writer, sheet_name=image_name)
+        # One sheet for all images, with a column identifying the image
+        df = pd.concat(
+            [pd.DataFrame(report_data).assign(Image=image_name)
+             for image_name, report_data in self.report_data.items()],
+            ignore_index=True
+        )
+        df = df[['Image'] + [col for col in df.columns if col != 'Image']]
+        df.to_excel(report_path, index=False)
         
         print(f"Report saved to: {report_path}")
     
+    def process_in_pool(self, files: List[Path]) -> List[Optional[Tuple[str, np.ndarray]]]:
+        """
+        Process files in parallel worker processes.
+        
+        An error in one file only skips that file. If the pool breaks (e.g. a
+        worker is killed, or the projector cannot be unpickled in spawned
+        workers when run from an editor console), the files that were not
+        completed are processed in this process instead.
+        
+        Args:
+            files: TIFF files to process
+            
+        Returns:
+            Results of process_tiff_file, in file order
+        """
+        results = [None] * len(files)
+        unfinished = []
+        
+        # Process files in parallel; writes in one worker overlap compute in others
+        n_workers = min(self.max_workers, len(files))
+        # Share the CPUs between workers instead of one Numba thread per CPU each
+        n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=limit_numba_threads,
+                                 initargs=(n_threads,)) as executor:
+            futures = [executor.submit(self.process_tiff_file, file_path) for file_path in files]
+            for i, (file_path, future) in enumerate(zip(files, futures)):
+                try:
+                    results[i] = future.result()
+                except BrokenProcessPool:
+                    unfinished.append(i)
+                except Exception as e:
+                    print(f"Error processing {file_path.name}: {e}")
+        
+        if unfinished:
+            print(f"Worker pool stopped; processing {len(unfinished)} remaining file(s) in this process")
+            for i in unfinished:
+                results[i] = self.process_tiff_file(files[i])
+        return results
+    
     def run(self) -> None:
         """Run the projection process on all TIFF files in the folder."""
         start_time = time.time()
@@ -201,14 +557,41 @@ class ImageProjector:
         print(f"Projection type: {self.projection_type}")
         print(f"Z-range: {self.z_range}")
         
-        # Process all TIFF files in the folder
+        # Collect all TIFF files in the folder
+        files = []
         for file_path in sorted(self.folder.iterdir()):
             if not file_path.is_file():
                 continue
                 
             # Check if file is TIFF and matches channel criteria
-            if file_path.suffix.lower() == '.tif' and any(channel in file_path.name for channel in self.channels):
-                self.process_tiff_file(file_path)
+            if (file_path.suffix.lower() == '.tif' and self._channel_re is not None
+                    and self._channel_re.search(file_path.name)):
+                files.append(file_path)
+        
+        if self.max_workers == 1:
+            # Process files here, overlapping each write with the next file
+            self._writer = ThreadPoolExecutor(max_workers=2)
+            try:
+                results = [self.process_tiff_file(file_path) for file_path in files]
+                while self._write_futs:
+                    self.wait_for_write(*self._write_futs.pop(0))
+            finally:
+                self._writer.shutdown()
+                self._writer = None
+        elif files:
+            results = self.process_in_pool(files)
+        else:
+            results = []
+        
+        # Merge reports in file order
+        for result in results:
+            if result is None:
+                continue
+            stem, report = result
+            if stem in self._failed_writes:
+                continue
+            self.report_data[stem] = report
+            self.processed_count += 1
         
         # Save report
         self.save_report()
@@ -229,13 +612,15 @@ def main():
     channels = ['WL508']
     projection_type = 'max'  # 'max' or 'mean'
     z_range = 1  # Number of Z-slices above/below center
+    max_workers = None  # Files processed in parallel (None: CPU count, 1: in-process with background writes)
     
     # Create projector and run
     projector = ImageProjector(
         folder=folder,
         channels=channels,
         projection_type=projection_type,
-        z_range=z_range
+        z_range=z_range,
+        max_workers=max_workers
     )
     
     projector.run()
@@ -6,7 +6,9 @@ using the Adjusted Rand Index (ARI) score.
 """
 
 import os
-from sklearn.metrics.cluster import adjusted_rand_score as ari
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import sparse
 from tifffile import imread
 import pandas as pd
 import sys
@@ -30,23 +32,30 @@ def get_tif_filenames(directory):
     filenames = [f for f in os.listdir(directory) if f.endswith('.tif')]
     return sorted(filenames)
 
-def find_matching_seg_file(ref_name, seg_dir):
+def sample_prefix(filename):
     """
-    Find the segmentation file matching the reference name prefix.
+    Get the sample prefix of a file: the first two '_'-separated parts of its name without extension.
+    Args:
+        filename (str): Mask filename.
+    Returns:
+        str: Sample prefix.
+    """
+    return '_'.join(os.path.splitext(filename)[0].split('_')[:2])
+
+def index_seg_files(seg_dir):
+    """
+    Index segmentation files by their sample prefix (first two '_'-separated parts).
     Args:
-        ref_name (str): Reference filename.
         seg_dir (str): Segmentation mask directory.
     Returns:
-        str or None: Full path to matching segmentation file, or None if not found.
+        dict: Mapping of sample prefix to full path of the first matching .tif file.
     """
-    parts = ref_name.split('_')
-    if len(parts) < 2:
-        return None
-    smp_prefix = f"{parts[0]}_{parts[1]}"
-    for seg_name in os.listdir(seg_dir):
-        if seg_name.endswith('.tif') and seg_name.startswith(smp_prefix):
-            return os.path.join(seg_dir, seg_name)
-    return None
+    seg_index = {}
+    for seg_name in sorted(os.listdir(seg_dir)):
+        prefix = sample_prefix(seg_name)
+        if seg_name.endswith('.tif') and '_' in prefix:
+            seg_index.setdefault(prefix, os.path.join(seg_dir, seg_name))
+    return seg_index
 
 def load_mask(filepath):
     """
@@ -63,6 +72,22 @@ def load_mask(filepath):
     except Exception as e:
         raise IOError(f"Failed to read mask file: {filepath}. Error: {e}")
 
+def load_mask_pair(ref_path, seg_path, sample_id):
+    """
+    Load a reference and segmentation mask pair.
+    Args:
+        ref_path (str): Path to the reference mask file.
+        seg_path (str): Path to the segmentation mask file.
+        sample_id (str): Sample name.
+    Returns:
+        tuple or None: (ref_mask, seg_mask, sample_name), or None if loading failed.
+    """
+    try:
+        return load_mask(ref_path), load_mask(seg_path), sample_id
+    except Exception as e:
+        print(f"[Error] Could not load masks for {sample_id}: {e}")
+        return None
+
 def collect_mask_pairs(ref_dir, seg_dir, ref_filenames):
     """
     Import and match mask pairs from reference and segmentation directories.
@@ -75,23 +100,29 @@ def collect_mask_pairs(ref_dir, seg_dir, ref_filenames):
     Raises:
         ValueError: If no matching pairs are found.
     """
-    pairs = []
+    seg_index = index_seg_files(seg_dir)
+    tasks = []
     for ref_name in ref_filenames:
         ref_path = os.path.join(ref_dir, ref_name)
-        seg_path = find_matching_seg_file(ref_name, seg_dir)
-        sample_id = '_'.join(ref_name.split('_')[:2])
+        sample_id = sample_prefix(ref_name)
+        seg_path = seg_index.get(sample_id)
         if not os.path.exists(ref_path):
             print(f"[Warning] Reference file missing: {ref_path}")
             continue
         if not seg_path or not os.path.exists(seg_path):
             print(f"[Warning] No matching segmentation file for: {sample_id}")
             continue
-        try:
-            ref_mask = load_mask(ref_path)
-            seg_mask = load_mask(seg_path)
-        except Exception as e:
-            print(f"[Error] Could not load masks for {sample_id}: {e}")
+        tasks.append((ref_path, seg_path, sample_id))
+    # TIFF decoding releases the GIL, so threads overlap reading of the masks
+    loaded = []
+    if tasks:
+        with ThreadPoolExecutor(max_workers=min(8, len(tasks))) as executor:
+            loaded = list(executor.map(lambda task: load_mask_pair(*task), tasks))
+    pairs = []
+    for result in loaded:
+        if result is None:
             continue
+        ref_mask, seg_mask, sample_id = result
         if ref_mask.shape != seg_mask.shape:
             print(f"[Error] Shape mismatch for {sample_id}: ref {ref_mask.shape}, seg {seg_mask.shape}")
             continue
@@ -102,6 +133,63 @@ def collect_mask_pairs(ref_dir, seg_dir, ref_filenames):
     print(f"\n[Info] Total valid matching pairs found: {len(pairs)}")
     return pairs
 
+def to_label_indices(labels):
+    """
+    Flatten a label image into non-negative integer labels.
+    Args:
+        labels (ndarray): Label image.
+    Returns:
+        ndarray: Flattened labels; negative or non-integer labels are relabeled
+            to consecutive indices, as sklearn does.
+    """
+    flat = labels.ravel()
+    if np.issubdtype(flat.dtype, np.integer) and (flat.size == 0 or flat.min() >= 0):
+        return flat
+    return np.unique(flat, return_inverse=True)[1].ravel()
+
+def fast_ari(labels_a, labels_b):
+    """
+    Compute the Adjusted Rand Index between two label images.
+    Builds the contingency table directly instead of going through sklearn's
+    generic label encoding: with a single bincount over combined label indices
+    when the dense table is small relative to the image, otherwise as a sparse
+    matrix. Negative or non-integer labels are first relabeled to indices.
+    Args:
+        labels_a (ndarray): Reference label image.
+        labels_b (ndarray): Segmentation label image of the same shape.
+    Returns:
+        float: ARI score.
+    """
+    a = to_label_indices(labels_a)
+    b = to_label_indices(labels_b)
+    n = a.size
+    n_rows = int(a.max()) + 1
+    n_cols = int(b.max()) + 1
+    if n_rows * n_cols <= 4 * n:
+        flat = a.astype(np.int64)
+        np.multiply(flat, n_cols, out=flat)
+        np.add(flat, b, out=flat, casting='unsafe')
+        cells = np.bincount(flat, minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+        row_sums = cells.sum(axis=1)
+        col_sums = cells.sum(axis=0)
+    else:
+        contingency = sparse.coo_matrix(
+            (np.ones(n, dtype=np.int64), (a, b)), shape=(n_rows, n_cols)).tocsr()
+        cells = contingency.data
+        row_sums = np.asarray(contingency.sum(axis=1)).ravel()
+        col_sums = np.asarray(contingency.sum(axis=0)).ravel()
+    # Pair counts; converted to Python ints so the products below cannot overflow
+    sum_comb = int((cells * (cells - 1)).sum()) // 2
+    sum_comb_a = int((row_sums * (row_sums - 1)).sum()) // 2
+    sum_comb_b = int((col_sums * (col_sums - 1)).sum()) // 2
+    total_comb = n * (n - 1) // 2
+    expected = sum_comb_a * sum_comb_b / total_comb if total_comb else 0.0
+    max_index = (sum_comb_a + sum_comb_b) / 2
+    if max_index == expected:
+        # Identical partitions (e.g. a single cluster), as in sklearn
+        return 1.0
+    return (sum_comb - expected) / (max_index - expected)
+
 def calculate_ari_for_pairs(mask_pairs, output_dir):
     """
     Calculate ARI for each mask pair and store results in a DataFrame and Excel file.
@@ -116,7 +204,7 @@ def calculate_ari_for_pairs(mask_pairs, output_dir):
     results = []
     for ref_mask, seg_mask, sample_id in mask_pairs:
         try:
-            score = ari(ref_mask.ravel(), seg_mask.ravel())
+            score = fast_ari(ref_mask, seg_mask)
             print(f"[Info] {sample_id}: ARI = {score:.4f}")
             results.append({'Sample_name': sample_id, 'ARI_value': score})
         except Exception as e: